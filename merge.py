@@ -1,16 +1,70 @@
 # coding: utf-8
 # import datetime
+import contextlib
 import errno
 import logging
 import os
+import re
+import shutil
 import sys
 import subprocess
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import fastjsonschema
 from errbot import BotPlugin, arg_botcmd, ValidationException
-from errbot.botplugin import recurse_check_structure
 
 logger = logging.getLogger(__file__)
 
+# An absolute path to git, together with `-C` instead of `cwd=`, lets CPython launch it with posix_spawn(); see
+# `Merge.spawn_subprocess`
+GIT = shutil.which('git') or 'git'
+
+# How often, in seconds, to do a full `fetch -p` of every project; merges only fetch the refs they need
+PRUNE_INTERVAL = 60 * 60
+
+# How long, in seconds, a `git cat-file --batch` process gets to exit on deactivation before it is killed
+CAT_FILE_EXIT_TIMEOUT = 5
+
+# Lets git's remote operations share one SSH connection per host, rather than each doing its own handshake; the
+# control sockets live in ~/.ssh (%C needs OpenSSH 6.7+)
+SSH_COMMAND = 'ssh -o ControlMaster=auto -o ControlPath=~/.ssh/err-merge-%C -o ControlPersist=10m'
+
+# Shared by every call to `Merge.get_configuration_template`, so treat it as read-only
+CONFIG_TEMPLATE = {
+    'REPOS_ROOT': '/home/web/repos/',
+    'forbidden_branches': ['master', 'develop'],  # Can't merge these
+    'CLONE_CONCURRENCY': 8,  # Maximum number of projects to clone at the same time
+    'MAX_CONCURRENT_MERGES': max(1, (os.cpu_count() or 2) * 3 // 4),  # Any more will wait their turn
+    # 'MERGE_FLAGS': '--no-ff',
+    # 'MERGE_COMMIT_TEMPLATE': '',
+    'projects': {
+        # Name of the project in GitHub
+        'some-project': 'git@github.com:netquity/some-project.git',
+    },
+}
+
+# Compiled once at import; fastjsonschema turns the schema into plain Python code instead of walking it on every check
+CONFIG_SCHEMA = fastjsonschema.compile({
+    'type': 'object',
+    'properties': {
+        'REPOS_ROOT': {'type': 'string'},
+        'forbidden_branches': {'type': 'array', 'items': {'type': 'string'}},
+        'CLONE_CONCURRENCY': {'type': 'integer', 'minimum': 1},
+        'MAX_CONCURRENT_MERGES': {'type': 'integer', 'minimum': 1},
+        'projects': {
+            # Any number of projects, mapping the name of the project in GitHub to its clone URL
+            'type': 'object',
+            'minProperties': 1,
+            'additionalProperties': {'type': 'string'},
+        },
+    },
+    # The concurrency settings came later, so configurations stored before them must stay valid
+    'required': ['REPOS_ROOT', 'forbidden_branches', 'projects'],
+    'additionalProperties': False,
+})
+
 
 class Merge(BotPlugin):  # pylint:disable=too-many-ancestors
     """Merge GitHub PRs your way.
@@ -27,57 +81,124 @@ class Merge(BotPlugin):  # pylint:disable=too-many-ancestors
             self.warn_admins(message)
             return
 
+        # The configuration is stored as given (lists and all), so keep lookup-friendly copies of what merges check
+        self._forbidden_branches = frozenset(self.config['forbidden_branches'])
+        self._forbidden_error_msg = '{} are forbidden choices for --branch-name.'.format(
+            ', '.join(str(branch) for branch in self.config['forbidden_branches'])
+        )
+        self._project_roots = {
+            project_name: os.path.join(self.config['REPOS_ROOT'], project_name)
+            for project_name in self.config['projects']
+        }
+
+        # Configurations from before this setting existed don't have it
+        self._max_concurrent_merges = self.config.get('MAX_CONCURRENT_MERGES', CONFIG_TEMPLATE['MAX_CONCURRENT_MERGES'])
+        self._merge_slots = threading.BoundedSemaphore(self._max_concurrent_merges)
+
+        # Long-running `git cat-file --batch` processes, keyed by project root; see `git_get_branch_author`
+        self._cat_file_procs = {}
+        self._cat_file_locks = {}
+        self._cat_file_closed = False
+        # Per-project locks for everything that depends on the remote refs staying put; see `get_ref_lock`
+        self._ref_locks = {}
+        self._locks_guard = threading.Lock()
+
         self.setup_repos()
+        self.detect_git_features()
         super().activate()
+        self.start_poller(PRUNE_INTERVAL, self.prune_repos)
+
+    def deactivate(self):
+        # errbot deactivates while commands may still be running, so hold the guard to keep new processes from being
+        # started, and each project's lock to let a lookup in progress finish first
+        with self._locks_guard:
+            self._cat_file_closed = True
+            for project_root, process in self._cat_file_procs.items():
+                with self._cat_file_locks[project_root]:
+                    # Closing stdin lets `cat-file` exit on its own; only a stuck one needs killing
+                    process.stdin.close()
+                    try:
+                        process.wait(timeout=CAT_FILE_EXIT_TIMEOUT)
+                    except subprocess.TimeoutExpired:
+                        process.kill()
+                        process.wait()
+                    process.stdout.close()
+            self._cat_file_procs.clear()
+        super().deactivate()
 
     def setup_repos(self):
-        """Clone the projects in the configuration into the `REPOS_ROOT` if they do not exist already."""
-        try:
-            os.makedirs(self.config['REPOS_ROOT'])
-        except OSError as exc:
-            # If the error is that the directory already exists, we don't care about it
-            if exc.errno != errno.EEXIST:
-                raise exc
+        """Clone the projects in the configuration into the `REPOS_ROOT` if they do not exist already.
+
+        Every project is also set up to reuse SSH connections through `SSH_COMMAND`, unless the operator already
+        configured how git should run ssh for it.
+        """
+        for path, mode in [(self.config['REPOS_ROOT'], 0o777), (os.path.expanduser('~/.ssh'), 0o700)]:
+            try:
+                os.makedirs(path, mode=mode)
+            except OSError as exc:
+                # If the error is that the directory already exists, we don't care about it
+                if exc.errno != errno.EEXIST:
+                    raise exc
 
+        # Decide what needs cloning up front so that no project is ever submitted twice
+        missing_projects = [
+            project_name for project_name in self.config['projects']
+            if not os.path.exists(self._project_roots[project_name])
+        ]
         for project_name in self.config['projects']:
-            if not os.path.exists(os.path.join(self.config['REPOS_ROOT'], project_name)):
-                # Possible race condition if folder somehow gets created between check and creation
+            project_root = self._project_roots[project_name]
+            if project_name not in missing_projects and not Merge.git_has_own_ssh_command(project_root):
                 Merge.run_subprocess(
-                    ['git', 'clone', self.config['projects'][project_name]],
-                    cwd=self.config['REPOS_ROOT'],
+                    [GIT, '-C', project_root, 'config', 'core.sshCommand', SSH_COMMAND],
                 )
+        if not missing_projects:
+            return
+
+        # Outside of any repo, this only sees the global/system config and the environment
+        clone_config = [] if Merge.git_has_own_ssh_command(self.config['REPOS_ROOT']) else [
+            '--config', 'core.sshCommand={}'.format(SSH_COMMAND),
+        ]
+
+        # Clones are network-bound, so run them concurrently to overlap the transfers
+        # Configurations from before this setting existed don't have it
+        clone_concurrency = self.config.get('CLONE_CONCURRENCY', CONFIG_TEMPLATE['CLONE_CONCURRENCY'])
+        max_workers = min(clone_concurrency, len(missing_projects))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                # Possible race condition if folder somehow gets created between check and creation
+                executor.submit(
+                    Merge.run_subprocess,
+                    [GIT, '-C', self.config['REPOS_ROOT'], 'clone'] + clone_config + [
+                        self.config['projects'][project_name],
+                    ],
+                )
+                for project_name in missing_projects
+            ]
+            for future in as_completed(futures):
+                future.result()  # Re-raise any failure from the worker thread
+
+    def detect_git_features(self):
+        """Decide how merges will be made, based on the installed git and each project's git config.
 
-    def get_configuration_template(self) -> str:
-        return {
-            'REPOS_ROOT': '/home/web/repos/',
-            'forbidden_branches': ['master', 'develop'],  # Can't merge these
-            # 'MERGE_FLAGS': '--no-ff',
-            # 'MERGE_COMMIT_TEMPLATE': '',
-            'projects': {
-                # Name of the project in GitHub
-                'some-project': 'git@github.com:netquity/some-project.git',
-            },
+        With git 2.38 or greater, merges are built with `merge-tree`/`commit-tree` and never touch a working tree;
+        older versions fall back to a worktree per merge.
+        """
+        version = re.search(r'(\d+)\.(\d+)', Merge.run_subprocess([GIT, 'version'], capture=True).stdout)
+        self._treeless_merge = tuple(int(part) for part in version.groups()) >= (2, 38)
+        # `commit-tree` ignores commit.gpgsign, so remember it for each project and ask for signing explicitly
+        self._sign_merges = {
+            project_root: Merge.git_wants_signed_commits(project_root) for project_root in self._project_roots.values()
         }
 
+    def get_configuration_template(self) -> dict:
+        return CONFIG_TEMPLATE
+
     def check_configuration(self, configuration: 'typing.Mapping') -> None:
         """Allow for the `projects` key to have a variable number of definitions."""
-        # Remove the `projects` key from both the template and the configuration and then test them separately
         try:
-            config_template = self.get_configuration_template().copy()
-            projects_template = config_template.pop('projects')
-            projects_config = configuration.pop('projects')  # Might fail
-        except KeyError:
-            raise ValidationException(
-                'Your configuration must include a projects key with at least one project configured.'
-            )
-
-        recurse_check_structure(config_template, configuration)
-
-        # Check that each project configuration matches the template
-        for k, v in projects_config.items():
-            recurse_check_structure(projects_template['some-project'], v)
-
-        configuration.update({'projects': projects_config})
+            CONFIG_SCHEMA(configuration)
+        except fastjsonschema.JsonSchemaException as exc:
+            raise ValidationException(exc.message)
 
     @arg_botcmd('--project-name', dest='project_name', type=str.lower, required=True)
     @arg_botcmd('--branch-name', dest='branch_name', type=str, required=True)
@@ -88,27 +209,53 @@ class Merge(BotPlugin):  # pylint:disable=too-many-ancestors
             branch_name: str,
     ) -> str:
         """For the given project, merge the given branch to develop and push back to origin."""
-        # TODO: validate project_name
-        project_root = self.get_project_root(project_name)
         try:
-            self.validate_branch(branch_name, project_root)
+            project_root = self.get_project_root(project_name)
         except ValidationException as exc:
-            failure_message = '%s is not a valid branch choice.' % branch_name
             self.log.exception(
-                failure_message,
+                str(exc),
             )
             return self.send_card(
                 in_reply_to=msg,
-                body=failure_message,
+                body=str(exc),
                 color='red',
             )
 
-        # TODO: trap your exceptions!
-        author = Merge.git_get_branch_author(project_root, branch_name)
+        # Everything from the fetch to the push works from one view of develop, so no other merge, fetch or prune of
+        # this project may move the remote refs in between. The slot is only taken once the lock is held, so merges
+        # queued behind a busy project don't keep the slots away from other projects while running no git at all.
+        with self.get_ref_lock(project_root), self.merge_slot(project_name):
+            try:
+                self.validate_branch(branch_name, project_root)
+            except ValidationException as exc:
+                failure_message = '%s is not a valid branch choice.' % branch_name
+                self.log.exception(
+                    failure_message,
+                )
+                return self.send_card(
+                    in_reply_to=msg,
+                    body=failure_message,
+                    color='red',
+                )
 
-        Merge.git_merge_branch_to_develop(project_root, branch_name, author, msg.frm.fullname)
-        Merge.git_push_develop_to_origin(project_root)
-        Merge.git_delete_branch(project_root, branch_name)
+            try:
+                # Pin the fetched refs to SHAs, so every later step agrees on exactly which commits are merged
+                develop, giver = Merge.git_resolve_merge_parents(project_root, branch_name)
+                if self._treeless_merge:
+                    self.merge_without_worktree(project_root, branch_name, develop, giver, msg.frm.fullname)
+                else:
+                    self.merge_in_worktree(project_root, project_name, branch_name, develop, giver, msg.frm.fullname)
+            except subprocess.CalledProcessError as exc:
+                failure_message = 'I was unable to merge %s to develop.' % branch_name
+                git_output = '\n'.join(output.strip() for output in (exc.output, exc.stderr) if output)
+                self.log.exception(
+                    '%s\n%s', failure_message, git_output,
+                )
+                return self.send_card(
+                    in_reply_to=msg,
+                    body='{}\n{}'.format(failure_message, git_output).strip(),
+                    color='red',
+                )
 
         return self.send_card(
             in_reply_to=msg,
@@ -120,113 +267,345 @@ class Merge(BotPlugin):  # pylint:disable=too-many-ancestors
             color='green',
         )
 
+    @contextlib.contextmanager
+    def merge_slot(self, project_name: str):
+        """Hold one of the `MAX_CONCURRENT_MERGES` slots, so a flood of commands can't start unbounded git processes."""
+        if not self._merge_slots.acquire(blocking=False):
+            self.log.warning(
+                'All %d merge slots are busy; the %s merge is waiting for one.',
+                self._max_concurrent_merges, project_name,
+            )
+            self._merge_slots.acquire()
+        try:
+            yield
+        finally:
+            self._merge_slots.release()
+
+    def merge_without_worktree(
+            self,
+            project_root: str,
+            branch_name: str,
+            develop: str,
+            giver: str,
+            invoking_user: str,
+    ):
+        """Merge the giver commit of the given branch to develop and push it, working on the object database alone."""
+        author = self.git_get_branch_author(project_root, giver)
+        commit = Merge.git_commit_merge(
+            project_root, branch_name, develop, giver, author, invoking_user, sign=self._sign_merges[project_root],
+        )
+        Merge.git_push_and_delete(project_root, branch_name, giver, commit)
+
+    def merge_in_worktree(
+            self,
+            project_root: str,
+            project_name: str,
+            branch_name: str,
+            develop: str,
+            giver: str,
+            invoking_user: str,
+    ):
+        """Merge the giver commit of the given branch to develop and push it, using a throwaway worktree.
+
+        This is the fallback for git older than 2.38.
+        """
+        # Every merge gets its own worktree, so a failed merge never leaves the shared clone in a half-merged state
+        worktree_root = tempfile.mkdtemp(prefix='merge-{}-'.format(project_name))
+        # Checking out develop doesn't depend on the author, so let git work on it while the author is looked up
+        worktree = Merge.git_add_worktree(project_root, worktree_root, develop)
+        try:
+            try:
+                author = self.git_get_branch_author(project_root, giver)
+            finally:
+                Merge.wait_or_raise(worktree)
+
+            Merge.git_merge_branch_to_develop(worktree_root, branch_name, giver, author, invoking_user)
+            Merge.git_push_and_delete(worktree_root, branch_name, giver, 'HEAD')
+        finally:
+            Merge.git_remove_worktree(project_root, worktree_root)
+
     def get_project_root(self, project_name: str) -> str:
         """Get the root of the project's Git repo locally."""
-        return self.config['REPOS_ROOT'] + project_name
+        try:
+            return self._project_roots[project_name]
+        except KeyError:
+            raise ValidationException('{} is not a configured project.'.format(project_name))
 
     def validate_branch(self, branch_name: str, project_root: str):
-        """Check that the given branch is not on the list of forbidden branches."""
-        if branch_name in self.config['forbidden_branches']:
-            raise ValidationException(
-                '{} are forbidden choices for --branch-name.'.format(
-                    ', '.join(str(branch) for branch in self.config['forbidden_branches'])
-                )
-            )
-        # TODO: make sure branch exists!
+        """Check that the given branch is not on the list of forbidden branches.
+
+        This is also where origin gets fetched, once per merge; the later steps work from the refs it brings in. Only
+        develop and the given branch are fetched, which keeps the negotiation small on repos with many refs; pruning
+        everything else is left to `prune_repos`. The caller must hold the project's `get_ref_lock`.
+        """
+        if branch_name in self._forbidden_branches:
+            raise ValidationException(self._forbidden_error_msg)
+        # Fetching a branch that isn't on origin fails, so a successful fetch also proves that it exists
         try:
-            for argv in [
-                    ['fetch', '-p'],
-                    ['rev-parse', '--verify', 'origin/%s' % branch_name],
-            ]:
-                Merge.run_subprocess(
-                    ['git'] + argv,
-                    cwd=project_root,
-                )
+            Merge.run_subprocess(
+                [
+                    GIT, '-C', project_root, 'fetch', '--no-tags', 'origin',
+                    '+refs/heads/develop:refs/remotes/origin/develop',
+                    '+refs/heads/{0}:refs/remotes/origin/{0}'.format(branch_name),
+                ],
+            )
         except subprocess.CalledProcessError as exc:
             raise ValidationException(
                 '{} is not a valid branch name.'.format(branch_name)
             )
 
 
+    def prune_repos(self):
+        """Do a full fetch of every project, removing the remote branches that are gone; run by a poller."""
+        for project_root in self._project_roots.values():
+            # One unreachable project must not stop the others from being pruned
+            try:
+                with self.get_ref_lock(project_root):
+                    Merge.run_subprocess(
+                        [GIT, '-C', project_root, 'fetch', '-p'],
+                    )
+            except subprocess.CalledProcessError as exc:
+                self.log.exception(
+                    'Could not prune %s:\n%s', project_root, (exc.stderr or '').strip(),
+                )
+
+    def get_ref_lock(self, project_root: str) -> threading.Lock:
+        """Get the lock serializing everything that reads or moves the remote refs of the given project.
+
+        A merge holds it from its fetch until its push, so that the develop it builds on is still the one on origin.
+        """
+        with self._locks_guard:
+            return self._ref_locks.setdefault(project_root, threading.Lock())
+
+    @staticmethod
+    def git_resolve_merge_parents(project_root: str, branch_name: str) -> 'typing.Tuple[str, str]':
+        """Get the SHAs of origin/develop and of the given branch on origin, as fetched by `validate_branch`."""
+        return tuple(Merge.run_subprocess(
+            [
+                GIT, '-C', project_root, 'rev-parse',
+                'refs/remotes/origin/develop^{commit}',
+                'refs/remotes/origin/{}^{{commit}}'.format(branch_name),
+            ],
+            capture=True,
+        ).stdout.split())
+
     @staticmethod
     def git_merge_branch_to_develop(
-            project_root: str,
+            worktree_root: str,
             branch_name: str,
+            giver: str,
             author: str,
             invoking_user: str,
     ):
-        """Merge the given branch into develop.
+        """Merge the giver commit of the given branch into develop, inside the worktree made by `git_add_worktree`.
 
         For the merge commit, use the:
             - the bot user as the committer
             - author of the branch as the author of the giver commit as the author
             - full name of the invoking user (the user who issues the command) as part of the commit message
+
+        The result is left at the worktree's HEAD for `git_push_and_delete` to publish.
         """
         for argv in [
-                ['fetch', '-p'],
-                ['checkout', '-B', 'develop', 'origin/develop'],
                 [
                     'merge', '--no-ff',
                     '-m', 'Merge {} to develop'.format(branch_name),
                     '-m', 'Branch merged by {}.'.format(invoking_user),
-                    'origin/{}'.format(branch_name),
+                    giver,
                 ],
                 ['commit', '--no-edit', '--amend', '--author={}'.format(author)],
-                ['push', 'origin', 'develop'],
         ]:
+            # `git merge` reports conflicts on stdout, so keep it for the error
             Merge.run_subprocess(
-                ['git'] + argv,
-                cwd=project_root,
+                [GIT, '-C', worktree_root] + argv,
+                capture=True,
             )
 
     @staticmethod
-    def git_push_develop_to_origin(project_root: str):
-        """Push the develop branch for the given project back to origin."""
-        Merge.run_subprocess(
-            ['git', 'push', 'origin', 'develop'],
-            cwd=project_root,
+    def git_commit_merge(
+            project_root: str,
+            branch_name: str,
+            develop: str,
+            giver: str,
+            author: str,
+            invoking_user: str,
+            sign: bool,
+    ) -> str:
+        """Create the merge commit of the given branch into develop without a working tree, and return its SHA.
+
+        The commit is the same as the one `git_merge_branch_to_develop` makes, but it is built with `merge-tree`
+        (git 2.38+) and `commit-tree`. `develop` and `giver` are SHAs, so the tree and the parents are guaranteed to
+        come from the same commits.
+        """
+        # A conflicting merge exits non-zero, which raises just like a failed `git merge` would
+        try:
+            tree = Merge.run_subprocess(
+                [GIT, '-C', project_root, 'merge-tree', '--write-tree', '--name-only', develop, giver],
+                capture=True,
+            ).stdout.split('\n', 1)[0]  # The tree is on the first line; conflict details, if any, follow it
+        except subprocess.CalledProcessError as exc:
+            # The tree and the conflicted files come first, then a blank line and the same CONFLICT messages that
+            # `git merge` prints; only keep those, so both ways of merging report conflicts alike
+            exc.output = exc.output.split('\n\n', 1)[-1]
+            raise
+
+        argv = [
+            'commit-tree', tree,
+            '-p', develop,
+            '-p', giver,
+            '-m', 'Merge {} to develop'.format(branch_name),
+            '-m', 'Branch merged by {}.'.format(invoking_user),
+        ]
+        if sign:
+            argv.append('-S')
+        # `commit-tree` has no --author, so pass it the way git itself would; the committer still comes from config
+        name, email = author.rstrip('>').rsplit(' <', 1)
+        return Merge.run_subprocess(
+            [GIT, '-C', project_root] + argv,
+            env=dict(os.environ, GIT_AUTHOR_NAME=name, GIT_AUTHOR_EMAIL=email),
+            capture=True,
+        ).stdout.strip()
+
+    @staticmethod
+    def git_has_own_ssh_command(path: str) -> bool:
+        """Check whether git at `path` already has an ssh command other than `SSH_COMMAND`, e.g. for a deploy key.
+
+        GIT_SSH_COMMAND beats core.sshCommand, which in turn beats GIT_SSH; setting core.sshCommand would silently
+        replace the latter two, so all of them count.
+        """
+        if os.environ.get('GIT_SSH_COMMAND') or os.environ.get('GIT_SSH'):
+            return True
+        # `config --get` exits with 1 when the key isn't set, so don't treat that as an error
+        stdout, _ = Merge.spawn_subprocess(
+            [GIT, '-C', path, 'config', '--get', 'core.sshCommand'],
+            capture=True,
+        ).communicate()
+        return stdout.strip() not in ('', SSH_COMMAND)
+
+    @staticmethod
+    def git_wants_signed_commits(project_root: str) -> bool:
+        """Check whether commit.gpgsign is turned on for the given project."""
+        # `config --get` exits with 1 when the key isn't set, so don't treat that as an error
+        stdout, _ = Merge.spawn_subprocess(
+            [GIT, '-C', project_root, 'config', '--bool', '--get', 'commit.gpgsign'],
+            capture=True,
+        ).communicate()
+        return stdout.strip() == 'true'
+
+    @staticmethod
+    def git_add_worktree(project_root: str, worktree_root: str, develop: str) -> subprocess.Popen:
+        """Start checking out develop into a new, detached worktree; pass the result to `wait_or_raise`."""
+        return Merge.spawn_subprocess(
+            [GIT, '-C', project_root, 'worktree', 'add', '--detach', worktree_root, develop],
         )
 
     @staticmethod
-    def git_delete_branch(project_root: str, branch_name: str):
+    def git_remove_worktree(project_root: str, worktree_root: str):
+        """Remove a worktree made by `git_add_worktree`, or only its directory if git never got to populate it."""
+        if os.path.exists(os.path.join(worktree_root, '.git')):
+            Merge.run_subprocess(
+                [GIT, '-C', project_root, 'worktree', 'remove', '--force', worktree_root],
+            )
+        else:
+            shutil.rmtree(worktree_root, ignore_errors=True)
+
+    @staticmethod
+    def git_push_and_delete(repo_root: str, branch_name: str, giver: str, commit: str):
+        """Push the given merge commit (a SHA, or HEAD inside a worktree) to develop and delete the merged branch.
+
+        Both ref updates go to origin in a single atomic push: one round-trip, and the branch only goes away if develop
+        actually moved. The delete is leased on `giver`, the SHA that was merged, so if someone pushed more commits to
+        the branch in the meantime the whole push fails instead of deleting work nobody merged.
+        """
         Merge.run_subprocess(
-            ['git', 'push', 'origin', '--delete', '{}'.format(branch_name)],
-            cwd=project_root,
+            [
+                GIT, '-C', repo_root, 'push', '--atomic', 'origin',
+                '--force-with-lease=refs/heads/{}:{}'.format(branch_name, giver),
+                '{}:refs/heads/develop'.format(commit),
+                ':refs/heads/{}'.format(branch_name),
+            ],
         )
 
-    @staticmethod
-    def git_get_branch_author(project_root: str, branch_name: str) -> str:
-        """Get the author information for the given branch.
+    def git_get_branch_author(self, project_root: str, commit: str) -> str:
+        """Get the author information for the given commit, the tip of the branch being merged.
 
         Return a string in the form: Firstname Lastname <email@domain.com>
         """
-        Merge.run_subprocess(
-            ['git', 'fetch', '-p'],
-            cwd=project_root,
+        process, lock = self.get_cat_file_process(project_root)
+        with lock:
+            process.stdin.write('{}\n'.format(commit).encode())
+            process.stdin.flush()
+            header = process.stdout.readline().split()
+            # A bad ref produces "<ref> missing" and no object to read afterwards
+            if len(header) != 3:
+                raise ValidationException('{} does not exist.'.format(commit))
+            commit_object = process.stdout.read(int(header[2]) + 1)  # The object is followed by a newline
+
+        # Only the headers are of interest, and the message may not even be UTF-8, so stay with bytes until the end
+        headers = dict(
+            line.split(b' ', 1) for line in commit_object.split(b'\n\n', 1)[0].split(b'\n') if b' ' in line
         )
+        # A commit made with i18n.commitEncoding declares it, and git uses it for the author too
+        encoding = headers.get(b'encoding', b'utf-8').decode('ascii', errors='replace')
+        # The author header looks like: Firstname Lastname <email@domain.com> 1500000000 +0000
+        author = headers[b'author'].rsplit(b' ', 2)[0]
+        try:
+            return author.decode(encoding, errors='replace')
+        except LookupError:  # An encoding Python doesn't know about
+            return author.decode('utf-8', errors='replace')
 
-        # A bad ref can produce too long of a result or an empty one
-        author = Merge.run_subprocess(
-            [
-                'git', 'for-each-ref', '--format="%(authorname) %(authoremail)"', 'refs/remotes/origin/{}'.format(
-                    branch_name,
-                ),
-            ],
-            cwd=project_root,
-        ).stdout.strip()  # Get rid of the newline character at the end
+    def get_cat_file_process(self, project_root: str) -> 'typing.Tuple[subprocess.Popen, threading.Lock]':
+        """Get the `git cat-file --batch` process for the given project, starting it if needed.
 
-        # A bad ref can produce too long of a result or an empty one
-        assert len(author.split('\n')) == 1 and len(author)
-        return author
+        Keeping one process alive per project saves a fork/exec for every lookup; the lock that comes with it must be
+        held for each request/response exchange on its pipes.
+        """
+        with self._locks_guard:
+            if self._cat_file_closed:
+                raise RuntimeError('Merge is being deactivated; not starting another git cat-file.')
+            process = self._cat_file_procs.get(project_root)
+            if process is None or process.poll() is not None:
+                process = self._cat_file_procs[project_root] = subprocess.Popen(
+                    [GIT, '-C', project_root, 'cat-file', '--batch'],
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                    close_fds=False,
+                )
+            return process, self._cat_file_locks.setdefault(project_root, threading.Lock())
 
     @staticmethod
-    def run_subprocess(args: list, cwd: str=None):
+    def run_subprocess(args: list, env: dict=None, capture: bool=False) -> subprocess.CompletedProcess:
         """Run the local command described by `args` with some defaults applied."""
-        return subprocess.run(
+        return Merge.wait_or_raise(Merge.spawn_subprocess(args, env=env, capture=capture))
+
+    @staticmethod
+    def spawn_subprocess(args: list, env: dict=None, capture: bool=False) -> subprocess.Popen:
+        """Start the local command described by `args` without waiting for it to finish.
+
+        This lets the caller get on with other work while git runs; hand the result to `wait_or_raise` when done.
+
+        Standard output is only kept when `capture` is set: for the commands whose output is actually read, and for
+        those that explain their failures there rather than on standard error (`git merge` prints its conflicts on
+        stdout). Standard error is always kept; git prints little else there when it isn't attached to a terminal.
+
+        On Linux with glibc 2.24+ (or macOS), CPython uses posix_spawn() instead of fork()/exec() as long as the
+        executable is an absolute path and neither `cwd`, `close_fds` nor `preexec_fn` are used, which keeps the cost
+        of starting git independent of the size of the bot process. Python's own descriptors are non-inheritable
+        (PEP 446), so leaving `close_fds` off doesn't leak them to the child.
+        """
+        return subprocess.Popen(
             args,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,  # Combine out/err into stdout; stderr will be None
+            stdout=subprocess.PIPE if capture else subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
             universal_newlines=True,
-            check=True,
-            cwd=cwd,
+            close_fds=False,
+            env=env,
         )
+
+    @staticmethod
+    def wait_or_raise(process: subprocess.Popen) -> subprocess.CompletedProcess:
+        """Wait for a process from `spawn_subprocess` and raise `CalledProcessError` if it failed."""
+        stdout, stderr = process.communicate()
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, process.args, output=stdout, stderr=stderr)
+        return subprocess.CompletedProcess(process.args, process.returncode, stdout=stdout, stderr=stderr)